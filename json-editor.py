@@ -1,57 +1,57 @@
-import json
+import orjson
 import pandas as pd
 import sys
 import os
 from collections import defaultdict
 
+# Column suffixes for the per-medication columns
+_DOSE = "_dose"
+_DOSE_UNIT = "_dose_unit"
+_REASON_STOPPED = "_reason_stopped"
+
+def normalize_med_name(name):
+    return name.strip().lower().replace(" ", "_")
+
 def flatten_json_column(json_str):
     try:
-        return json.loads(json_str)
+        return orjson.loads(json_str)
     except:
         return {}
 
-def extract_med_columns(df, key):
+def extract_med_columns(entries, key):
+    # Column -> {row index: value}, so the frame is built column by column
     med_cols = defaultdict(dict)
-    for i, row in df.iterrows():
-        entry = flatten_json_column(row["structured_output"])
+    presence_cols = set()
+    key_prefix = key + "_"
+    for i, entry in enumerate(entries):
         for med in entry.get(key, []):
-            name = med.get("name", "").strip().lower().replace(" ", "_")
-            dose = med.get("dose")
-            dose_unit = med.get("dose_unit", "")
-            col_prefix = f"{key}_{name}"
-            med_cols[i][f"{col_prefix}"] = True
-            med_cols[i][f"{col_prefix}_dose"] = dose
-            med_cols[i][f"{col_prefix}_dose_unit"] = dose_unit
-    return pd.DataFrame.from_dict(med_cols, orient="index")
+            get = med.get
+            col_prefix = key_prefix + normalize_med_name(get("name", ""))
+            presence_cols.add(col_prefix)
+            med_cols[col_prefix][i] = True
+            med_cols[col_prefix + _DOSE][i] = get("dose")
+            med_cols[col_prefix + _DOSE_UNIT][i] = get("dose_unit", "")
+    med_df = pd.DataFrame(med_cols, index=range(len(entries)))
+    return med_df.astype(dict.fromkeys(presence_cols, "boolean"))
 
-def extract_prev_med_reason(df):
+def extract_prev_med_reason(entries):
     reason_cols = defaultdict(dict)
-    for i, row in df.iterrows():
-        entry = flatten_json_column(row["structured_output"])
+    for i, entry in enumerate(entries):
         for med in entry.get("previous_medications", []):
-            name = med.get("name", "").strip().lower().replace(" ", "_")
-            reason = med.get("reason_stopped", "")
-            col_prefix = f"previous_{name}"
-            reason_cols[i][f"{col_prefix}_reason_stopped"] = reason
-    return pd.DataFrame.from_dict(reason_cols, orient="index")
-
-def extract_core_fields(df):
-    flat_data = []
-    for i, row in df.iterrows():
-        entry = flatten_json_column(row["structured_output"])
-        flat_row = {"PATNR": row["PATNR"]}
+            get = med.get
+            col = "previous_" + normalize_med_name(get("name", "")) + _REASON_STOPPED
+            reason_cols[col][i] = get("reason_stopped", "")
+    return pd.DataFrame(reason_cols, index=range(len(entries)))
 
-        for key, value in entry.items():
-            if key in ["medications", "previous_medications"]:
-                continue
-            elif isinstance(value, dict):
-                for subkey, subval in value.items():
-                    flat_row[f"{key}_{subkey}"] = subval
-            else:
-                flat_row[key] = value
-
-        flat_data.append(flat_row)
-    return pd.DataFrame(flat_data)
+def extract_core_fields(patnrs, entries):
+    # Nested sections become "{section}_{field}" columns
+    records = [
+        {k: v for k, v in entry.items() if k not in ("medications", "previous_medications")}
+        for entry in entries
+    ]
+    flat_df = pd.json_normalize(records, sep="_")
+    flat_df.insert(0, "PATNR", patnrs)
+    return flat_df
 
 def main():
     if len(sys.argv) < 2:
@@ -59,12 +59,15 @@ def main():
         return
 
     input_file = sys.argv[1]
-    df = pd.read_csv(input_file)
+    df = pd.read_csv(input_file, usecols=["PATNR", "structured_output"])
+
+    # Decode each structured_output cell once and share it across extractors
+    entries = df["structured_output"].map(flatten_json_column).tolist()
 
-    core_df = extract_core_fields(df)
-    current_df = extract_med_columns(df, "medications")
-    prev_df = extract_med_columns(df, "previous_medications")
-    reason_df = extract_prev_med_reason(df)
+    core_df = extract_core_fields(df["PATNR"].to_numpy(), entries)
+    current_df = extract_med_columns(entries, "medications")
+    prev_df = extract_med_columns(entries, "previous_medications")
+    reason_df = extract_prev_med_reason(entries)
 
     result = pd.concat([core_df, current_df, prev_df, reason_df], axis=1)
     output_file = os.path.splitext(input_file)[0] + "_flattened.csv"
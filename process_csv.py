@@ -1,16 +1,24 @@
-import json
+import csv
+import orjson
 import os
 import sys
 import pandas as pd
 import ollama
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional
 
 PROMPT_FILES = {
     "Epilepsy": "prompts/epilepsy_prompt.txt"
 }
 
+# Number of concurrent Ollama requests; match the server's OLLAMA_NUM_PARALLEL
+MAX_WORKERS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+
+# Keep the model resident between patients so it is not reloaded per request
+KEEP_ALIVE = "30m"
+
 
 class Medication(BaseModel):
     name: str
@@ -83,8 +91,7 @@ def load_prompt(filepath):
         return f.read()
 
 
-def query_llama(report_text, prompt_template):
-    system_prompt = prompt_template.replace("{report}", "")
+def query_llama(report_text, system_prompt):
     try:
         response = ollama.chat(
             model="que",
@@ -92,7 +99,8 @@ def query_llama(report_text, prompt_template):
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": report_text}
             ],
-            options={"temperature": 0}
+            options={"temperature": 0},
+            keep_alive=KEEP_ALIVE
         )
         content = response["message"]["content"]
         content = content.strip()
@@ -102,38 +110,53 @@ def query_llama(report_text, prompt_template):
             start = content.index("{")
             end = content.rindex("}") + 1
             json_str = content[start:end]
-            data = json.loads(json_str)
+            # Parse and validate in a single pass over the raw JSON
+            validated = PatientEpilepsyReport.model_validate_json(json_str)
+        except ValidationError as e:
+            if any(err["type"] == "json_invalid" for err in e.errors()):
+                print("❌ JSON parsing failed")
+                return orjson.dumps({"error": f"Failed to parse JSON: {str(e)}", "raw": content}).decode()
+            print("❌ Validation failed")
+            return orjson.dumps({"error": f"Validation error: {str(e)}", "raw": json_str}).decode()
         except Exception as e:
             print("❌ JSON parsing failed")
-            return json.dumps({"error": f"Failed to parse JSON: {str(e)}", "raw": content})
+            return orjson.dumps({"error": f"Failed to parse JSON: {str(e)}", "raw": content}).decode()
 
         try:
-            validated = PatientEpilepsyReport.model_validate(data)
             flat_data = validated.model_dump()
 
-            # Print each top-level variable
-            print("🔍 Extracted variables:")
+            # Print each top-level variable (in one call so worker threads don't interleave)
+            lines = ["🔍 Extracted variables:"]
             for key, value in flat_data.items():
                 if isinstance(value, dict):
                     for sub_key, sub_value in value.items():
-                        print(f"  {key}.{sub_key}: {sub_value}")
+                        lines.append(f"  {key}.{sub_key}: {sub_value}")
                 elif isinstance(value, list):
-                    print(f"  {key}:")
+                    lines.append(f"  {key}:")
                     for item in value:
-                        print(f"    - {item}")
+                        lines.append(f"    - {item}")
                 else:
-                    print(f"  {key}: {value}")
+                    lines.append(f"  {key}: {value}")
+            print("\n".join(lines))
 
-            return json.dumps(flat_data, ensure_ascii=False)
+            return orjson.dumps(flat_data).decode()
 
         except Exception as e:
             print("❌ Validation failed")
-            return json.dumps({"error": f"Validation error: {str(e)}", "raw": json_str})
+            return orjson.dumps({"error": f"Validation error: {str(e)}", "raw": json_str}).decode()
 
     except Exception as e:
         print("❌ Ollama call failed")
 
-        return json.dumps({"error": f"Ollama call failed: {str(e)}"})
+        return orjson.dumps({"error": f"Ollama call failed: {str(e)}"}).decode()
+
+
+def process_patient(patnr, combined_text, system_prompt):
+    print(f"Processing patient {patnr}...")
+    if not combined_text:
+        return ""
+
+    return query_llama(combined_text, system_prompt)
 
 
 def main():
@@ -144,33 +167,48 @@ def main():
     file_path = sys.argv[1]
     sep = "\t" if file_path.endswith(".tsv") else ","
 
+    # Only parse the columns we use; a callable keeps missing ones from raising
+    usecols = lambda c: c in ("PATNR", "Beurteilung")
     try:
-        df = pd.read_csv(file_path, sep=sep, encoding="utf-8")
+        df = pd.read_csv(file_path, sep=sep, encoding="utf-8", usecols=usecols)
     except UnicodeDecodeError:
-        df = pd.read_csv(file_path, sep=sep, encoding="latin1")
+        df = pd.read_csv(file_path, sep=sep, encoding="latin1", usecols=usecols)
 
     if "PATNR" not in df.columns or "Beurteilung" not in df.columns:
         print("Missing required columns 'PATNR' or 'Beurteilung'")
         return
 
-    prompt_text = load_prompt(PROMPT_FILES["Epilepsy"])
-    grouped = df.groupby("PATNR")
-    outputs = []
+    # Few patients, many notes: group on integer category codes, not strings
+    df["PATNR"] = df["PATNR"].astype("category")
 
-    for patnr, group in grouped:
-        print(f"Processing patient {patnr}...")
-        all_texts = group["Beurteilung"].dropna().astype(str).tolist()
-        if not all_texts:
-            outputs.append({"PATNR": patnr, "structured_output": ""})
-            continue
+    # The report goes in the user message, so the system prompt is the same
+    # for every patient and only needs to be built once
+    system_prompt = load_prompt(PROMPT_FILES["Epilepsy"]).replace("{report}", "")
 
-        combined_text = "\n\n".join(all_texts)
-        response = query_llama(combined_text, prompt_text)
-        outputs.append({"PATNR": patnr, "structured_output": response})
+    # Join all reports per patient in one pass; patients without any report
+    # are kept with an empty text so they still get an output row
+    combined = (
+        df.dropna(subset=["Beurteilung"])
+        .astype({"Beurteilung": str})
+        .groupby("PATNR", observed=True)["Beurteilung"]
+        .agg("\n\n".join)
+        .reindex(df["PATNR"].cat.categories, fill_value="")
+    )
 
-    out_df = pd.DataFrame(outputs)
     output_file = os.path.splitext(file_path)[0] + "_structured_gpt.csv"
-    out_df.to_csv(output_file, index=False)
+
+    # Requests are I/O-bound, so threads overlap the Ollama round-trips;
+    # ex.map keeps the output in PATNR order. Rows are written as they come
+    # in, so finished patients are on disk even if the run is interrupted.
+    with open(output_file, "w", newline="", encoding="utf-8") as f, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(["PATNR", "structured_output"])
+        responses = ex.map(lambda kv: process_patient(*kv, system_prompt), combined.items())
+        for patnr, response in zip(combined.index, responses):
+            writer.writerow([patnr, response])
+            f.flush()
+
     print(f"\n✅ Done. Output saved to {output_file}")
 
 